@@ -6,6 +6,7 @@ Includes methods for calculating averages and retrieving agency summaries.
 Author: Sepehr Rafiei
 """
 
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from .db import AgencyMetrics
 
@@ -18,9 +19,10 @@ def get_top_agencies_by_word_count(session: Session, limit=10):
     )
 
 def get_average_section_length(session: Session):
-    agencies = session.query(AgencyMetrics).all()
-    total_words = sum(a.word_count for a in agencies)
-    total_sections = sum(a.section_count for a in agencies)
+    total_words, total_sections = session.query(
+        func.sum(AgencyMetrics.word_count),
+        func.sum(AgencyMetrics.section_count)
+    ).one()
     return total_words / total_sections if total_sections else 0
 
 def get_agency_summary(session: Session, agency_name: str):
@@ -13,6 +13,7 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
+from functools import lru_cache
 from sqlalchemy.exc import OperationalError
 
 Base = declarative_base()
@@ -23,7 +24,7 @@ class AgencyMetrics(Base):
     name = Column(String, unique=True)
     scope = Column(JSON)
     section_count = Column(Integer)
-    word_count = Column(Integer)
+    word_count = Column(Integer, index=True)
     updated_at = Column(DateTime, default=datetime.utcnow)
 
 # Use environment variable for database URL, fallback to SQLite for local development
@@ -33,20 +34,34 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///data/ecfr.db")
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-def get_engine(max_retries=5, retry_delay=2):
-    """Create database engine with retry logic."""
+# Reuse pooled connections across requests and drop stale ones (e.g. Render Postgres idling out)
+if DATABASE_URL.startswith("sqlite"):
+    ENGINE_OPTIONS = {"connect_args": {"check_same_thread": False}}
+else:
+    ENGINE_OPTIONS = {"pool_size": 10, "max_overflow": 20, "pool_pre_ping": True, "pool_recycle": 1800}
+
+@lru_cache(maxsize=1)
+def get_engine():
+    """Create the database engine on first use; connections are only opened when needed."""
+    return create_engine(DATABASE_URL, **ENGINE_OPTIONS)
+
+def check_connection(max_retries=5, retry_delay=2):
+    """Test the database connection with retry logic."""
     for attempt in range(max_retries):
         try:
-            engine = create_engine(DATABASE_URL)
-            # Test the connection
-            with engine.connect() as conn:
+            with get_engine().connect() as conn:
                 conn.execute(text("SELECT 1"))
-            return engine
+            return
         except OperationalError as e:
             if attempt == max_retries - 1:
                 raise
             print(f"Database connection attempt {attempt + 1} failed. Retrying in {retry_delay} seconds...")
             time.sleep(retry_delay)
 
-engine = get_engine()
-SessionLocal = sessionmaker(bind=engine)
+_session_factory = sessionmaker()
+
+def SessionLocal():
+    """Open a new session, binding the session factory to the engine on first DB use."""
+    if _session_factory.kw.get("bind") is None:
+        _session_factory.configure(bind=get_engine())
+    return _session_factory()
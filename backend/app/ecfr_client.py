@@ -8,27 +8,34 @@ Author: Sepehr Rafiei
 
 from pathlib import Path
 import os
-import json
+import orjson
 import requests
+import aiohttp
+import asyncio
+from requests.adapters import HTTPAdapter
 import logging
 from tenacity import retry, stop_after_attempt, wait_exponential
 from datetime import datetime, timedelta
-import concurrent.futures
 from tqdm import tqdm
 
 from .config import HEADERS
 
 logger = logging.getLogger(__name__)
 DATA_DIR = Path(__file__).resolve().parents[1] / "data"
+DOWNLOAD_WORKERS = 8
+
+# Shared keep-alive session so repeated API requests reuse TCP/TLS connections
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
 
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=10)
 )
-def fetch_with_retry(url, headers=None):
-    """Fetch data from URL with retries."""
+def fetch_with_retry(url, headers=None, session=None):
+    """Fetch data from URL with retries, using the given requests session if any."""
     try:
-        response = requests.get(url, headers=headers, timeout=30)
+        response = (session or requests).get(url, headers=headers, timeout=30)
         response.raise_for_status()
         return response
     except requests.exceptions.RequestException as e:
@@ -44,27 +51,29 @@ def fetch_and_cache(url, rel_path, max_age_hours=24):
         file_age = datetime.now() - datetime.fromtimestamp(full_path.stat().st_mtime)
         if file_age < timedelta(hours=max_age_hours):
             logger.info(f"Using cached data from {rel_path}")
-            with open(full_path, 'r') as f:
-                return json.load(f)
+            return orjson.loads(full_path.read_bytes())
     
     logger.info(f"Fetching fresh data from {url}")
-    res = fetch_with_retry(url, headers=HEADERS)
-    data = res.json()
+    res = fetch_with_retry(url, headers=HEADERS, session=http_session)
+    data = orjson.loads(res.content)
 
     # Ensure directory exists
     full_path.parent.mkdir(parents=True, exist_ok=True)
     
-    # Save to cache
-    with open(full_path, 'w') as f:
-        json.dump(data, f, indent=2)
+    # Save the raw response bytes to cache instead of re-serializing
+    full_path.write_bytes(res.content)
     
     return data
 
 def extract_all_refs(agency):
-    """Recursively get all cfr_references from an agency and its children."""
-    refs = agency.get("cfr_references", [])
-    for child in agency.get("children", []):
-        refs.extend(extract_all_refs(child))
+    """Get all cfr_references from an agency and its children, depth first."""
+    refs = []
+    stack = [agency]
+    while stack:
+        current = stack.pop()
+        refs.extend(current.get("cfr_references", ()))
+        # Push children in reverse so they are visited in their original order
+        stack.extend(reversed(current.get("children", ())))
     return refs
 
 def get_agency_scope_map():
@@ -75,47 +84,64 @@ def get_agency_scope_map():
             "agencies/agencies.json"
         )
         
-        agency_scope = {}
-        for agency in data["agencies"]:
-            refs = extract_all_refs(agency)
-            if refs:
-                agency_scope[agency["name"]] = refs
-        return agency_scope
+        return {
+            agency["name"]: refs
+            for agency in data["agencies"]
+            if (refs := extract_all_refs(agency))
+        }
     except Exception as e:
         logger.error(f"Error getting agency scope map: {str(e)}")
         raise
 
-def download_title(title_num, date):
-    """Download a single title file."""
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=4, max=10)
+)
+async def fetch_bytes_with_retry(session, url, headers=None):
+    """Fetch raw bytes from URL over an aiohttp session with retries."""
+    try:
+        async with session.get(url, headers=headers) as response:
+            response.raise_for_status()
+            return await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Error fetching {url}: {str(e)}")
+        raise
+
+async def download_title(session, semaphore, title_num, date):
+    """Download a single title file unless the copy on disk is already this amended version."""
     try:
         path = DATA_DIR / f"titles/title-{title_num}.xml"
+        # Download URLs are versioned by the amended-on date, so the date the local copy
+        # came from is stored next to it and an unchanged date means nothing to fetch
+        date_path = path.with_suffix(".date")
+        # Format date as YYYY-MM-DD
+        formatted_date = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d")
         
-        # Check if we need to download or update the file
-        if not path.exists() or (
-            datetime.now() - datetime.fromtimestamp(path.stat().st_mtime)
-        ) > timedelta(hours=24):
-            logger.info(f"Downloading title {title_num}")
-            # Format date as YYYY-MM-DD
-            formatted_date = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d")
-            url = f'https://www.ecfr.gov/api/versioner/v1/full/{formatted_date}/title-{title_num}.xml'
-            res = fetch_with_retry(url, headers=HEADERS)
-            
-            path.parent.mkdir(parents=True, exist_ok=True)
-            with open(path, 'wb') as f:
-                f.write(res.content)
-            logger.info(f"Successfully downloaded title {title_num}")
-            return True
-        else:
+        if path.exists() and date_path.exists() and date_path.read_text().strip() == formatted_date:
             logger.debug(f"Title {title_num} is up to date")
             return False
+        
+        async with semaphore:
+            logger.info(f"Downloading title {title_num}")
+            url = f'https://www.ecfr.gov/api/versioner/v1/full/{formatted_date}/title-{title_num}.xml'
+            content = await fetch_bytes_with_retry(session, url, headers=HEADERS)
+        
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write off the event loop so large titles don't stall the other downloads
+        await asyncio.to_thread(path.write_bytes, content)
+        # Only record the version once the XML itself is on disk
+        await asyncio.to_thread(date_path.write_text, formatted_date)
+        logger.info(f"Successfully downloaded title {title_num}")
+        return True
     except Exception as e:
         logger.error(f"Error downloading title {title_num}: {str(e)}")
         return False
 
-def ensure_titles_downloaded():
-    """Ensure all titles are downloaded with proper error handling."""
+async def ensure_titles_downloaded_async():
+    """Ensure all titles are downloaded, fetching them concurrently over one connection pool."""
     try:
-        meta = fetch_and_cache(
+        meta = await asyncio.to_thread(
+            fetch_and_cache,
             "https://www.ecfr.gov/api/versioner/v1/titles.json",
             "titles_meta.json"
         )
@@ -130,20 +156,24 @@ def ensure_titles_downloaded():
                 continue
             download_tasks.append((title_num, date))
 
-        # Download titles in parallel
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            futures = [executor.submit(download_title, title_num, date) 
-                      for title_num, date in download_tasks]
+        # Download titles concurrently, at most DOWNLOAD_WORKERS at a time
+        semaphore = asyncio.Semaphore(DOWNLOAD_WORKERS)
+        connector = aiohttp.TCPConnector(limit=16, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(sock_connect=30, sock_read=30)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            tasks = [download_title(session, semaphore, title_num, date)
+                     for title_num, date in download_tasks]
             
             # Track progress
-            for future in tqdm(concurrent.futures.as_completed(futures), 
-                             total=len(futures),
+            for task in tqdm(asyncio.as_completed(tasks),
+                             total=len(tasks),
                              desc="Downloading titles"):
-                try:
-                    future.result()
-                except Exception as e:
-                    logger.error(f"Error in download task: {str(e)}")
+                await task
                 
     except Exception as e:
         logger.error(f"Error ensuring titles are downloaded: {str(e)}")
         raise
+
+def ensure_titles_downloaded():
+    """Ensure all titles are downloaded with proper error handling."""
+    asyncio.run(ensure_titles_downloaded_async())
@@ -3,8 +3,10 @@ import json
 import requests
 from pathlib import Path
 from dotenv import load_dotenv
-import xml.etree.ElementTree as ET
+from lxml import etree
 from collections import defaultdict
+from functools import lru_cache
+from itertools import product
 from datetime import datetime
 
 env_path = Path(__file__).resolve().parents[2] / ".env"
@@ -16,6 +18,8 @@ HEADERS = {
     "Accept": "application/json",
     "User-Agent": "eCFRAnalyzer/1.0"
 }
+TAG_ORDER = [('DIV1', 'title'), ('DIV3', 'chapter'), ('DIV5', 'part')]
+_COUNT_SECTIONS = etree.XPath("count(.//DIV8)")
 
 
 def fetch_agencies():
@@ -59,41 +63,96 @@ def get_agency_scope_map(path="data/agencies/agencies.json"):
 
 
 
-def get_section_and_word_count_by_structure(path, structure):
-    tree = ET.parse(path)
-    root = tree.getroot()
+def count_words(elem):
+    # One str.split() over the joined text counts the same words as splitting each
+    # text node; bytes.split() would be a bit faster but misses Unicode whitespace
+    # such as U+00A0, so it would disagree with xml_parser
+    return len(" ".join(elem.itertext()).split())
+
+
+def count_subtree(elem):
+    return int(_COUNT_SECTIONS(elem)), count_words(elem)
+
+
+@lru_cache(maxsize=None)
+def _ancestor_xpath(tags):
+    # Compiled once per combination of enclosing DIV tags, e.g. ancestor::DIV3[@N=$DIV3] and ancestor::DIV1[@N=$DIV1]
+    return etree.XPath(" and ".join(f"ancestor::{tag}[@N=${tag}]" for tag in tags))
 
-    tag_order = [('DIV1', 'title'), ('DIV3', 'chapter'), ('DIV5', 'part')]
-    current_element = root
 
-    # Navigate to the deepest specified level
-    for tag, key in tag_order:
-        value = structure.get(key)
-        if value is None:
+def structure_key(structure):
+    return tuple(None if structure.get(key) is None else str(structure[key]) for _, key in TAG_ORDER)
+
+
+def build_div_index(root):
+    # Map (title, chapter, part) N values to their DIV in one pass. Each DIV is
+    # registered under every mix of its real ancestor Ns and omitted (None) levels,
+    # so any structure that names a subset of the levels is a single dict lookup.
+    levels = {tag: i for i, (tag, _) in enumerate(TAG_ORDER)}
+    index = {(None, None, None): root}
+    for elem in root.iter(*levels):
+        n = elem.get("N")
+        if n is None:
             continue
-        found = False
-        for elem in current_element.iter(tag):
-            if elem.attrib.get("N") == str(value):
-                current_element = elem
-                found = True
-                break
-        if not found:
-            return 0, 0  # If any level doesn't match, return zero counts
+        level = levels[elem.tag]
+        path = [None] * len(TAG_ORDER)
+        path[level] = n
+        if level:
+            for ancestor in elem.iterancestors(*(tag for tag, _ in TAG_ORDER[:level])):
+                i = levels[ancestor.tag]
+                if path[i] is None:
+                    path[i] = ancestor.get("N")
+        tail = (n,) + (None,) * (len(path) - level - 1)
+        for head in product(*({p, None} for p in path[:level])):
+            index.setdefault(head + tail, elem)
+    return index
+
+
+def _xml_parser():
+    # Same defensive huge_tree setting as xml_parser, lifting libxml2's per-node caps the
+    # stdlib parser never had; parsers aren't thread-safe, so build one per parse
+    return etree.XMLParser(huge_tree=True)
+
+
+@lru_cache(maxsize=None)
+def _parse_title(title_num):
+    root = etree.parse(f"data/titles/title-{title_num}.xml", _xml_parser()).getroot()
+    return root, build_div_index(root)
+
+
+@lru_cache(maxsize=None)
+def _count_structure(title_num, key):
+    # Subtree counts are only computed the first time a structure is requested
+    elem = _parse_title(title_num)[1].get(key)
+    if elem is None:
+        return 0, 0  # If any level doesn't match, return zero counts
+    return count_subtree(elem)
+
+
+def get_counts_for_title(title_num, structure):
+    return _count_structure(title_num, structure_key(structure))
+
+
+def get_section_and_word_count_by_structure(path, structure):
+    wanted = [(tag, str(structure[key])) for tag, key in TAG_ORDER if structure.get(key) is not None]
+
+    if not wanted:
+        return count_subtree(etree.parse(path, _xml_parser()).getroot())
 
-    def count_words(elem):
-        count = 0
-        if elem.text:
-            count += len(elem.text.split())
-        for child in elem:
-            count += count_words(child)
-            if child.tail:
-                count += len(child.tail.split())
-        return count
+    # Stream the file and only keep the deepest requested DIV in memory
+    target_tag, target_n = wanted[-1]
+    ancestors = dict(wanted[:-1])
+    in_ancestors = _ancestor_xpath(tuple(ancestors)) if ancestors else None
+    for _, elem in etree.iterparse(path, events=("end",), tag=target_tag, huge_tree=True):
+        if elem.get("N") == target_n and (in_ancestors is None or in_ancestors(elem, **ancestors)):
+            return count_subtree(elem)
 
-    section_count = sum(1 for _ in current_element.iter("DIV8"))
-    word_count = count_words(current_element)
+        # Free the non-matching subtree and everything parsed before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
 
-    return section_count, word_count
+    return 0, 0  # If any level doesn't match, return zero counts
 
 
 
@@ -140,7 +199,7 @@ def get_agency_data():
         for dep in deps:
             print(dep)
             title = dep['title']
-            section_count, word_count = get_section_and_word_count_by_structure(f'data/titles/title-{title}.xml', dep)
+            section_count, word_count = get_counts_for_title(title, dep)
             sections += section_count
             words += word_count
         agency_dict[agency] = (sections, words)
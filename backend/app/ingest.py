@@ -7,8 +7,11 @@ Author: Sepehr Rafiei
 """
 
 from .ecfr_client import get_agency_scope_map, ensure_titles_downloaded
-from .xml_parser import get_section_and_word_count_by_structure
+from .xml_parser import load_or_build_counts, get_structure_key, process_pool
 from .db import SessionLocal, AgencyMetrics
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import logging
 from datetime import datetime, timedelta
 import time
@@ -18,8 +21,8 @@ from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
 
-# Cache for XML parsing results
-xml_cache = {}
+# Agencies written per upsert statement and commit
+UPSERT_BATCH_SIZE = 50
 
 def download_all_data():
     """Download all required data before processing."""
@@ -40,88 +43,151 @@ def download_all_data():
         logger.error(f"Error during data download: {str(e)}")
         raise
 
+def _ref_key(ref):
+    """Build the (title, chapter, part) key a CFR reference is counted under."""
+    return (ref['title'], ref.get('chapter', ''), ref.get('part', ''))
+
+def _count_ref(title, chapter, part):
+    """Count sections and words for one (title, chapter, part) reference."""
+    try:
+        key = get_structure_key({'title': title, 'chapter': chapter, 'part': part})
+        # load_or_build_counts keeps each title's index in memory keyed on the file's stat
+        return load_or_build_counts(title).get(key, (0, 0))
+    except Exception as e:
+        logger.error(f"Error counting title {title} chapter {chapter} part {part}: {str(e)}")
+        return 0, 0
+
+def _build_title_counts(title):
+    """
+    Build (or refresh) the cached counts for one title in a worker process.
+    Returns (title, ok) so one unreadable title doesn't abort the whole pool.
+    """
+    try:
+        load_or_build_counts(title)
+        return title, True
+    except Exception as e:
+        logger.error(f"Error counting title {title}: {str(e)}")
+        return title, False
+
+def prepare_title_counts(agency_map):
+    """
+    Make sure every referenced title has fresh precomputed counts, parsing each
+    stale title in its own worker process. Returns the titles that can be counted.
+    """
+    titles = set()
+    skipped = set()
+    for refs in agency_map.values():
+        for ref in refs:
+            title = ref['title']
+            if title in titles or title in skipped:
+                continue
+
+            # Skip title 35 as it's missing
+            if title == 35:
+                logger.warning("Skipping title 35 as it's missing")
+                skipped.add(title)
+                continue
+
+            # Check if file exists
+            if not Path(f"data/titles/title-{title}.xml").exists():
+                logger.warning(f"Missing file for title {title}, skipping...")
+                skipped.add(title)
+                continue
+
+            titles.add(title)
+
+    counted = set()
+    if titles:
+        logger.info(f"Preparing counts for {len(titles)} titles...")
+        try:
+            with process_pool(os.cpu_count()) as pool:
+                for title, ok in tqdm(pool.map(_build_title_counts, titles), total=len(titles), desc="Counting titles"):
+                    if ok:
+                        counted.add(title)
+                    else:
+                        logger.warning(f"Could not count title {title}, skipping...")
+        except Exception as e:
+            # e.g. a worker died and broke the pool; titles not counted yet are skipped
+            logger.error(f"Error preparing title counts: {str(e)}")
+    return counted
+
+def upsert_agency_metrics(session, rows, batch_size=UPSERT_BATCH_SIZE):
+    """Insert or update agency metrics rows keyed on agency name, one statement and commit per batch."""
+    logger.info(f"Upserting {len(rows)} agencies...")
+
+    dialect = session.get_bind().dialect.name
+    ids = None
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        if dialect in ("postgresql", "sqlite"):
+            insert = pg_insert if dialect == "postgresql" else sqlite_insert
+            stmt = insert(AgencyMetrics).values(batch)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[AgencyMetrics.name],
+                set_={col: stmt.excluded[col] for col in ("scope", "section_count", "word_count", "updated_at")}
+            )
+            session.execute(stmt)
+        else:
+            # No native upsert, so split the batch against the names already stored
+            if ids is None:
+                ids = dict(session.execute(select(AgencyMetrics.name, AgencyMetrics.id)).all())
+                logger.info(
+                    f"{sum(r['name'] in ids for r in rows)} existing, "
+                    f"{sum(r['name'] not in ids for r in rows)} new"
+                )
+            session.bulk_insert_mappings(AgencyMetrics, [r for r in batch if r['name'] not in ids])
+            session.bulk_update_mappings(AgencyMetrics, [dict(r, id=ids[r['name']]) for r in batch if r['name'] in ids])
+
+        # Commit per batch so a failure late in the run keeps the earlier agencies
+        session.commit()
+
+def _sum_ref_counts(keys, titles):
+    """Sum the counts for a list of reference keys, skipping titles that can't be counted."""
+    section_total = 0
+    word_total = 0
+    processed_refs = 0
+    skipped_refs = 0
+    for key in keys:
+        if key[0] not in titles:
+            skipped_refs += 1
+            continue
+        section_count, word_count = _count_ref(*key)
+        section_total += section_count
+        word_total += word_count
+        processed_refs += 1
+    return section_total, word_total, processed_refs, skipped_refs
+
 def process_agency_data(agency_map):
     """Process all agency data after download is complete."""
     session = None
     try:
         logger.info("Starting data processing phase...")
-        session = SessionLocal()
+
+        titles = prepare_title_counts(agency_map)
         
-        # Process all agencies with progress bar
+        # Sum the precounted results for each agency with progress bar
+        rows = []
+        updated_at = datetime.now()
+        totals_by_refs = {}
         for name, refs in tqdm(agency_map.items(), desc="Processing agencies"):
-            try:
-                logger.info(f"Processing agency: {name}")
-                section_total = 0
-                word_total = 0
-                processed_refs = 0
-                skipped_refs = 0
-                
-                # Process each reference for the agency
-                for ref in refs:
-                    try:
-                        title = ref['title']
-                        logger.info(f"Processing title {title} for agency {name}")
-                        file_path = f"data/titles/title-{title}.xml"
-                        
-                        # Skip title 35 as it's missing
-                        if title == 35:
-                            logger.warning("Skipping title 35 as it's missing")
-                            skipped_refs += 1
-                            continue
-                            
-                        # Check if file exists
-                        if not Path(file_path).exists():
-                            logger.warning(f"Missing file for title {title}, skipping...")
-                            skipped_refs += 1
-                            continue
-                        
-                        # Check cache first
-                        cache_key = f"{title}_{ref.get('chapter', '')}_{ref.get('part', '')}"
-                        if cache_key in xml_cache:
-                            section_count, word_count = xml_cache[cache_key]
-                            logger.info(f"Using cached results for title {title}")
-                        else:
-                            section_count, word_count = get_section_and_word_count_by_structure(file_path, ref)
-                            xml_cache[cache_key] = (section_count, word_count)
-                            
-                        section_total += section_count
-                        word_total += word_count
-                        processed_refs += 1
-                        logger.info(f"Title {title} processed: {section_count} sections, {word_count} words")
-                    except Exception as e:
-                        logger.error(f"Error processing reference {ref} for agency {name}: {str(e)}")
-                        skipped_refs += 1
-                        continue
-                
-                logger.info(f"Agency {name} processed: {processed_refs} references processed, {skipped_refs} skipped")
-                
-                # Update or create agency metrics
-                existing = session.query(AgencyMetrics).filter_by(name=name).first()
-                if existing:
-                    logger.info(f"Updating existing agency: {name}")
-                    existing.scope = refs
-                    existing.section_count = section_total
-                    existing.word_count = word_total
-                    existing.updated_at = datetime.now()
-                else:
-                    logger.info(f"Creating new agency: {name}")
-                    new = AgencyMetrics(
-                        name=name,
-                        scope=refs,
-                        section_count=section_total,
-                        word_count=word_total,
-                        updated_at=datetime.now()
-                    )
-                    session.add(new)
-                
-                # Commit after each agency to prevent long transactions
-                session.commit()
-                logger.info(f"Successfully processed agency: {name}")
-                
-            except Exception as e:
-                logger.error(f"Error processing agency {name}: {str(e)}")
-                session.rollback()
-                continue
+            # Parent and child agencies often share the exact same reference list
+            refs_key = tuple(_ref_key(ref) for ref in refs)
+            if refs_key not in totals_by_refs:
+                totals_by_refs[refs_key] = _sum_ref_counts(refs_key, titles)
+            section_total, word_total, processed_refs, skipped_refs = totals_by_refs[refs_key]
+            
+            logger.info(f"Agency {name} processed: {processed_refs} references processed, {skipped_refs} skipped")
+            rows.append({
+                'name': name,
+                'scope': refs,
+                'section_count': section_total,
+                'word_count': word_total,
+                'updated_at': updated_at
+            })
+
+        if rows:
+            session = SessionLocal()
+            upsert_agency_metrics(session, rows)
             
         logger.info("Data processing phase completed successfully")
             
@@ -129,6 +195,7 @@ def process_agency_data(agency_map):
         logger.error(f"Error in process_agency_data: {str(e)}")
         if session:
             session.rollback()
+        raise
     finally:
         if session:
             session.close()
@@ -148,14 +215,3 @@ def run_ingestion():
     except Exception as e:
         logger.error(f"Error in run_ingestion: {str(e)}")
         raise
-
-def refresh_all_data():
-    """Refresh all data with proper error handling."""
-    try:
-        logger.info("Starting data refresh process...")
-        run_ingestion()
-        logger.info("Data refresh completed successfully")
-    except Exception as e:
-        logger.error(f"Error during refresh: {str(e)}")
-        # Don't raise the exception, allow the app to continue
-        pass
\ No newline at end of file
@@ -6,20 +6,22 @@ Provides endpoints for agency metrics, health checks, and manual data refresh.
 Author: Sepehr Rafiei
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+import asyncio
 import logging
 from datetime import datetime
 from pathlib import Path
 import os
 
-from .db import SessionLocal, Base, engine, AgencyMetrics
+from .db import SessionLocal, Base, get_engine, check_connection, AgencyMetrics
 from .analyzer import get_top_agencies_by_word_count, get_agency_summary
-from .ingest import run_ingestion, refresh_all_data
+from .ingest import run_ingestion
 from .config import HEADERS
 
 # Setup logging
@@ -27,7 +29,8 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # FastAPI app setup
-app = FastAPI(title="eCFR Analyzer API")
+# orjson serializes responses (including datetimes) natively and much faster than stdlib json
+app = FastAPI(title="eCFR Analyzer API", default_response_class=ORJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -37,8 +40,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize scheduler
-scheduler = BackgroundScheduler()
+# Initialize scheduler on the app's event loop so coroutine jobs are awaited
+scheduler = AsyncIOScheduler()
+
+# Only one refresh runs at a time; its progress is tracked in memory
+REFRESH_LOCK = asyncio.Lock()
+refresh_status = {
+    "state": "idle",
+    "started_at": None,
+    "finished_at": None,
+    "error": None
+}
 
 # Dependency for DB sessions
 def get_db():
@@ -52,8 +64,9 @@ def get_db():
 async def startup_event():
     """Initialize database and load initial data if needed."""
     try:
-        # Create database tables
-        Base.metadata.create_all(engine)
+        # Wait for the database to accept connections, then create tables
+        check_connection()
+        Base.metadata.create_all(get_engine())
         
         # Check if we need to load initial data or force refresh
         db = SessionLocal()
@@ -64,14 +77,9 @@ async def startup_event():
         
         if agency_count == 0 or force_refresh:
             logger.info("Starting data load...")
-            try:
-                # Run initial data load in a separate task
-                await refresh_data_task()
-                logger.info("Initial data load completed successfully")
-            except Exception as e:
-                logger.error(f"Error during initial data load: {str(e)}")
-                # Continue startup even if initial load fails
-                pass
+            # Run the initial load as a background task so startup returns and the API serves
+            # requests meanwhile; keep a reference so the task isn't garbage collected
+            app.state.initial_load = asyncio.create_task(background_refresh_task("Initial data load"))
         
         # Schedule daily updates at 2 AM UTC
         scheduler.add_job(
@@ -89,24 +97,42 @@ async def startup_event():
         # Don't raise the exception, allow the app to start
         pass
 
+async def background_refresh_task(description="Data refresh"):
+    """
+    Run refresh_data_task in the background, logging any failure instead of raising
+    since nothing awaits it; the outcome is recorded in refresh_status.
+    """
+    try:
+        await refresh_data_task()
+        logger.info(f"{description} completed successfully")
+    except Exception as e:
+        logger.error(f"Error during {description.lower()}: {str(e)}")
+
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on shutdown."""
     scheduler.shutdown()
 
 async def refresh_data_task():
-    """Task to refresh data with logging."""
-    try:
-        logger.info("Starting data refresh...")
+    """Task to refresh data with logging, run off the event loop so the API stays responsive."""
+    async with REFRESH_LOCK:
         start_time = datetime.now()
-        
-        refresh_all_data()
-        
-        duration = datetime.now() - start_time
-        logger.info(f"Data refresh completed successfully in {duration}")
-    except Exception as e:
-        logger.error(f"Error refreshing data: {str(e)}")
-        raise
+        refresh_status.update(state="running", started_at=start_time, finished_at=None, error=None)
+        try:
+            logger.info("Starting data refresh...")
+            
+            # run_ingestion raises on failure, so the status can report it
+            await asyncio.get_running_loop().run_in_executor(None, run_ingestion)
+            
+            duration = datetime.now() - start_time
+            refresh_status["state"] = "completed"
+            logger.info(f"Data refresh completed successfully in {duration}")
+        except Exception as e:
+            refresh_status.update(state="failed", error=str(e))
+            logger.error(f"Error refreshing data: {str(e)}")
+            raise
+        finally:
+            refresh_status["finished_at"] = datetime.now()
 
 # Health check endpoint
 @app.get("/api/health")
@@ -114,66 +140,92 @@ def health_check():
     """Health check endpoint."""
     return {
         "status": "healthy",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now()
+    }
+
+# Database health check endpoint
+@app.get("/api/health/db")
+def health_check_db():
+    """Check that the database accepts connections."""
+    try:
+        check_connection(max_retries=1)
+    except Exception as e:
+        logger.error(f"Database health check failed: {str(e)}")
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now()
     }
 
 # GET all agency data
 @app.get("/api/agencies")
-def api_agencies():
-    db = SessionLocal()
-    try:
-        agencies = db.query(AgencyMetrics).all()
-        return [
-            {
-                "name": a.name,
-                "section_count": a.section_count,
-                "word_count": a.word_count,
-                "scope": a.scope,
-                "updated_at": a.updated_at.isoformat()
-            }
-            for a in agencies
-        ]
-    finally:
-        db.close()
+def api_agencies(db: Session = Depends(get_db)):
+    # Only select summary columns; the scope JSON is served by /api/agencies/{name}/scope
+    rows = db.execute(
+        select(
+            AgencyMetrics.name,
+            AgencyMetrics.section_count,
+            AgencyMetrics.word_count,
+            AgencyMetrics.updated_at
+        )
+    ).all()
+    # Return the response directly so the rows skip FastAPI's jsonable_encoder pass
+    return ORJSONResponse([
+        {
+            "name": name,
+            "section_count": section_count,
+            "word_count": word_count,
+            "updated_at": updated_at
+        }
+        for name, section_count, word_count, updated_at in rows
+    ])
+
+# GET the CFR scope of a single agency
+@app.get("/api/agencies/{agency_name}/scope")
+def api_agency_scope(agency_name: str, db: Session = Depends(get_db)):
+    scope = db.execute(
+        select(AgencyMetrics.scope).where(AgencyMetrics.name == agency_name)
+    ).first()
+    if not scope:
+        raise HTTPException(status_code=404, detail="Agency not found")
+    return {"name": agency_name, "scope": scope[0]}
 
 # GET top N agencies by word count
 @app.get("/api/top-agencies")
-def api_top_agencies(limit: int = 10):
-    db = SessionLocal()
-    try:
-        top = get_top_agencies_by_word_count(db, limit)
-        return [{"name": a.name, "word_count": a.word_count} for a in top]
-    finally:
-        db.close()
+def api_top_agencies(limit: int = 10, db: Session = Depends(get_db)):
+    top = get_top_agencies_by_word_count(db, limit)
+    return [{"name": a.name, "word_count": a.word_count} for a in top]
 
 # GET single agency metrics
 @app.get("/api/agency/{agency_name}")
-def api_agency_detail(agency_name: str):
-    db = SessionLocal()
-    try:
-        agency = get_agency_summary(db, agency_name)
-        if not agency:
-            raise HTTPException(status_code=404, detail="Agency not found")
-        return {
-            "name": agency.name,
-            "word_count": agency.word_count,
-            "section_count": agency.section_count,
-            "scope": agency.scope,
-            "updated_at": agency.updated_at.isoformat()
-        }
-    finally:
-        db.close()
+def api_agency_detail(agency_name: str, db: Session = Depends(get_db)):
+    agency = get_agency_summary(db, agency_name)
+    if not agency:
+        raise HTTPException(status_code=404, detail="Agency not found")
+    return {
+        "name": agency.name,
+        "word_count": agency.word_count,
+        "section_count": agency.section_count,
+        "scope": agency.scope,
+        "updated_at": agency.updated_at
+    }
 
 # POST to refresh data manually
-@app.post("/api/refresh")
-async def api_refresh_data():
-    """Manually trigger data refresh."""
-    try:
-        await refresh_data_task()
-        return {"status": "success", "message": "Data refreshed and stored in DB."}
-    except Exception as e:
-        logger.error(f"Error in manual refresh: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to refresh data")
+@app.post("/api/refresh", status_code=202)
+async def api_refresh_data(background_tasks: BackgroundTasks):
+    """Manually trigger data refresh; it runs in the background and can be polled via /api/refresh/status."""
+    if REFRESH_LOCK.locked() or refresh_status["state"] == "running":
+        return {"status": "running", "message": "A data refresh is already in progress."}
+    # Mark the refresh as running before returning, so a second POST that arrives before
+    # the background task takes the lock doesn't queue another full refresh
+    refresh_status.update(state="running", started_at=datetime.now(), finished_at=None, error=None)
+    background_tasks.add_task(background_refresh_task, "Manual data refresh")
+    return {"status": "accepted", "message": "Data refresh started."}
+
+# GET the state of the latest data refresh
+@app.get("/api/refresh/status")
+def api_refresh_status():
+    return refresh_status
 
 if __name__ == "__main__":
     import uvicorn
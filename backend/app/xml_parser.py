@@ -6,13 +6,15 @@ Handles hierarchical structure of eCFR documents.
 Author: Sepehr Rafiei
 """
 
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 from pathlib import Path
 import logging
 import os
-import hashlib
-import json
+import pickle
 from functools import lru_cache
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 
 logger = logging.getLogger(__name__)
 
@@ -20,41 +22,150 @@ logger = logging.getLogger(__name__)
 DATA_DIR = Path(__file__).resolve().parents[1] / "data"
 CACHE_DIR = DATA_DIR / "cache"
 
-def get_cache_key(filename, structure):
-    """Generate a cache key for a file and structure combination."""
-    key_data = f"{filename}:{json.dumps(structure, sort_keys=True)}"
-    return hashlib.md5(key_data.encode()).hexdigest()
-
-def get_cached_result(cache_key):
-    """Get cached result if it exists."""
-    cache_file = CACHE_DIR / f"{cache_key}.json"
-    if cache_file.exists():
-        try:
-            with open(cache_file, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.warning(f"Error reading cache file: {str(e)}")
-    return None
-
-def save_to_cache(cache_key, section_count, word_count):
-    """Save result to cache."""
+# DIV levels a structure can navigate by, outermost first
+TAG_ORDER = [('DIV1', 'title'), ('DIV3', 'chapter'), ('DIV5', 'part')]
+SECTION_TAG = 'DIV8'
+LEVEL_BY_TAG = {tag: i for i, (tag, _) in enumerate(TAG_ORDER)}
+
+def _wc(text):
+    """Count the whitespace-separated words in a text or tail, which may be None."""
+    # str.count(" ") drifts on the newline/indent runs in eCFR XML and measured no
+    # faster than split(), so keep split()'s exact word boundaries
+    return len(text.split()) if text else 0
+
+def stat_title_file(filename):
+    """
+    Resolve a title filename to its path under DATA_DIR/titles and stat it.
+    Returns (file_path, os.stat_result), or None if the file is missing or empty.
+    """
+    # Sanitize filename in case user passes full or partial path
+    clean_filename = Path(filename).name  # strips out folders, keeps only 'title-1.xml'
+    file_path = DATA_DIR / "titles" / clean_filename
+
+    # One stat both checks the file exists and gives the size and mtime for the index cache
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        logger.warning(f"Missing XML file: {file_path}")
+        return None
+
+    if stat.st_size == 0:
+        logger.warning(f"Empty XML file: {file_path}")
+        return None
+
+    # Called for every structure lookup, so only build the message when it will be shown
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Found XML file {file_path} of size {stat.st_size} bytes")
+    return file_path, stat
+
+def get_structure_key(structure):
+    """Build the (title, chapter, part) lookup key for a structure, with None for omitted levels."""
+    return tuple(str(structure[key]) if structure.get(key) else None for _, key in TAG_ORDER)
+
+def _index_title(file_path):
+    """
+    Stream a title XML once and count sections and words for every DIV1/DIV3/DIV5.
+    Returns {(title, chapter, part): (section_count, word_count)}. Each DIV is stored
+    under every mix of its ancestors' N values and None, so any structure resolves
+    with get_structure_key(); (None, None, None) holds the totals for the whole file.
+    """
+    levels = LEVEL_BY_TAG
+    counts = {}
+    # One [section_count, word_count, path, level] accumulator per open element, plus the
+    # document; level is only set for DIVs with an N, which get an entry in counts
+    stack = [[0, 0, (None,) * len(TAG_ORDER), None]]
+
+    # Pass the path so libxml2 reads the file itself. huge_tree is defensive: it lifts
+    # libxml2's per-node caps (nesting depth, single text nodes over 10 MB) that the
+    # stdlib parser never had, so lxml accepts any title ElementTree did
+    for event, elem in ET.iterparse(
+        str(file_path), events=("start", "end"), remove_comments=True, remove_pis=True, huge_tree=True
+    ):
+        if event == "start":
+            path = stack[-1][2]
+            level = levels.get(elem.tag)
+            if level is not None:
+                n = elem.get("N")
+                if n:
+                    path = path[:level] + (n,) + (None,) * (len(path) - level - 1)
+                else:
+                    level = None
+            stack.append([0, 0, path, level])
+            continue
+
+        section_count, word_count, path, level = stack.pop()
+        if elem.tag == SECTION_TAG:
+            section_count += 1
+        # Children are closed by now, so the element's text and their tails are complete
+        word_count += _wc(elem.text)
+        for child in elem:
+            word_count += _wc(child.tail)
+
+        if level is not None:
+            tail = path[level:]
+            for head in product(*({p, None} for p in path[:level])):
+                counts.setdefault(head + tail, (section_count, word_count))
+
+        parent = stack[-1]
+        parent[0] += section_count
+        parent[1] += word_count
+        # Keep the tail for the parent's count but free the counted children
+        elem.clear(keep_tail=True)
+
+    counts[(None, None, None)] = tuple(stack[0][:2])
+    return counts
+
+@lru_cache(maxsize=64)
+def _load_index(xml_path, mtime, size):
+    """
+    Return _index_title() for a title file, keeping hot titles in memory. The
+    pickled index in CACHE_DIR is reused while it was built from the same
+    (path, mtime, size); a re-downloaded XML changes the key and is re-indexed.
+    """
+    xml_path = Path(xml_path)
+    index_path = CACHE_DIR / f"{xml_path.stem}.idx.pkl"
+    key = (str(xml_path), mtime, size)
+    try:
+        if index_path.exists():
+            cached = pickle.loads(index_path.read_bytes())
+            if cached["key"] == key:
+                logger.info(f"Using cached index for {xml_path.name}")
+                return cached["counts"]
+    except Exception as e:
+        logger.warning(f"Error reading index cache for {xml_path.name}: {str(e)}")
+
+    try:
+        counts = _index_title(xml_path)
+        logger.info(f"Indexed {len(counts)} structures in {xml_path.name}")
+    except ET.ParseError as e:
+        logger.error(f"Error parsing XML file {xml_path}: {str(e)}")
+        return {}
+
     try:
         CACHE_DIR.mkdir(parents=True, exist_ok=True)
-        cache_file = CACHE_DIR / f"{cache_key}.json"
-        with open(cache_file, 'w') as f:
-            json.dump({
-                'section_count': section_count,
-                'word_count': word_count
-            }, f)
+        # Write to a temp file first so a concurrent reader never sees a partial pickle
+        tmp_path = index_path.with_suffix(".tmp")
+        tmp_path.write_bytes(pickle.dumps({"key": key, "counts": counts}, protocol=5))
+        tmp_path.replace(index_path)
     except Exception as e:
-        logger.warning(f"Error saving to cache: {str(e)}")
+        logger.warning(f"Error saving index cache for {xml_path.name}: {str(e)}")
+    return counts
+
+def title_index(filename):
+    """
+    Return the {(title, chapter, part): (section_count, word_count)} index for a
+    title file, from memory, the on-disk index cache or a single fresh parse.
+    Returns {} if the XML is missing, empty or invalid.
+    """
+    found = stat_title_file(filename)
+    if found is None:
+        return {}
+    file_path, stat = found
+    return _load_index(str(file_path), stat.st_mtime, stat.st_size)
 
-@lru_cache(maxsize=100)
-def count_words_in_text(text):
-    """Count words in text with caching."""
-    if not text:
-        return 0
-    return len(text.split())
+def load_or_build_counts(title):
+    """Return title_index() for a title number."""
+    return title_index(f"title-{title}.xml")
 
 def get_section_and_word_count_by_structure(filename, structure):
     """
@@ -62,86 +173,50 @@ def get_section_and_word_count_by_structure(filename, structure):
     structure: dict like {'title': 1, 'chapter': 'III', 'part': '425'}
     """
     try:
-        # Check cache first
-        cache_key = get_cache_key(filename, structure)
-        cached_result = get_cached_result(cache_key)
-        if cached_result:
-            logger.info(f"Using cached results for {filename}")
-            return cached_result['section_count'], cached_result['word_count']
-
-        # Sanitize filename in case user passes full or partial path
-        clean_filename = Path(filename).name  # strips out folders, keeps only 'title-1.xml'
-        file_path = DATA_DIR / "titles" / clean_filename
-
-        logger.info(f"Processing XML file: {file_path}")
-
-        if not file_path.exists():
-            logger.warning(f"Missing XML file: {file_path}")
-            return 0, 0
-
-        # Check file size
-        file_size = os.path.getsize(file_path)
-        if file_size == 0:
-            logger.warning(f"Empty XML file: {file_path}")
-            return 0, 0
-
-        logger.info(f"Parsing XML file of size {file_size} bytes...")
-        try:
-            tree = ET.parse(file_path)
-            root = tree.getroot()
-            logger.info("XML file parsed successfully")
-        except ET.ParseError as e:
-            logger.error(f"Error parsing XML file {file_path}: {str(e)}")
-            return 0, 0
-
-        tag_order = [('DIV1', 'title'), ('DIV3', 'chapter'), ('DIV5', 'part')]
-        current_element = root
-
-        for tag, key in tag_order:
-            value = structure.get(key)
-            if not value:
-                continue
-            logger.info(f"Looking for {tag} with value {value}")
-            found = False
-            for elem in current_element.iter(tag):
-                if elem.attrib.get("N") == str(value):
-                    current_element = elem
-                    found = True
-                    logger.info(f"Found matching {tag}")
-                    break
-            if not found:
-                logger.warning(f"No matching {tag} found for value {value}")
-                return 0, 0
-
-        def count_words(elem, depth=0):
-            if depth > 100:  # Prevent infinite recursion
-                logger.warning("Maximum recursion depth reached in word counting")
-                return 0
-            try:
-                count = count_words_in_text(elem.text) if elem.text else 0
-                for child in elem:
-                    count += count_words(child, depth + 1)
-                    if child.tail:
-                        count += count_words_in_text(child.tail)
-                return count
-            except Exception as e:
-                logger.error(f"Error counting words in element: {str(e)}")
-                return 0
-
-        logger.info("Counting sections and words...")
-        try:
-            section_count = sum(1 for _ in current_element.iter("DIV8"))
-            word_count = count_words(current_element)
-            logger.info(f"Found {section_count} sections and {word_count} words")
-            
-            # Save to cache
-            save_to_cache(cache_key, section_count, word_count)
-            
-            return section_count, word_count
-        except Exception as e:
-            logger.error(f"Error counting sections/words: {str(e)}")
-            return 0, 0
-        
+        # Every structure in a title is answered from the same index, so the file is parsed at most once
+        return title_index(filename).get(get_structure_key(structure), (0, 0))
     except Exception as e:
         logger.error(f"Error processing XML file {filename}: {str(e)}")
         return 0, 0
+
+def get_section_count_by_structure(filename, structure):
+    """
+    Return only the DIV8 section count for a structure; same arguments as
+    get_section_and_word_count_by_structure().
+    """
+    return get_section_and_word_count_by_structure(filename, structure)[0]
+
+def process_pool(max_workers=None):
+    """
+    Create a ProcessPoolExecutor for title parsing. Workers are spawned rather than
+    forked: callers run inside uvicorn next to the scheduler, and forking a threaded
+    process can deadlock on locks held by other threads.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+def _count_title_structures(job):
+    """Worker: answer every structure requested for one title file from its index."""
+    filename, structures = job
+    return [get_section_and_word_count_by_structure(filename, structure) for structure in structures]
+
+def parse_many(requests, max_workers=None):
+    """
+    Count many (filename, structure) requests, indexing distinct title files in
+    parallel worker processes. Requests are grouped by file so each title is
+    parsed once by one worker. Returns (filename, structure, section_count,
+    word_count) tuples in request order.
+    """
+    requests = list(requests)
+    jobs = {}
+    for filename, structure in requests:
+        jobs.setdefault(Path(filename).name, []).append(structure)
+
+    with process_pool(max_workers) as pool:
+        counts = {
+            clean_filename: iter(results)
+            for clean_filename, results in zip(jobs, pool.map(_count_title_structures, jobs.items()))
+        }
+    return [
+        (filename, structure, *next(counts[Path(filename).name]))
+        for filename, structure in requests
+    ]